@@ -1,11 +1,13 @@
 import os
+import re
 import sqlite3
 import csv
 import io
-from datetime import datetime, timedelta, time
+import threading
+from datetime import datetime, time
 from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
-from typing import Optional, Tuple, List
+from typing import NamedTuple, Optional
 
 from telegram import (
     Update, InlineKeyboardMarkup, InlineKeyboardButton, ChatMemberUpdated, MessageEntity, ReplyKeyboardMarkup
@@ -20,6 +22,7 @@ from telegram.ext import (
 # ---------------- Config & DB ----------------
 load_dotenv()
 TOKEN = os.getenv("TELEGRAM_TOKEN")
+UTC = ZoneInfo("UTC")
 TZ = ZoneInfo(os.getenv("TIMEZONE", "Europe/Madrid"))
 MAX_HOURS = float(os.getenv("MAX_HOURS_WITHOUT_WALK", "6"))
 
@@ -33,64 +36,155 @@ def parse_hhmm(s):
 
 QUIET_START = parse_hhmm(os.getenv("QUIET_START", "23:00"))
 QUIET_END = parse_hhmm(os.getenv("QUIET_END", "07:30"))
+# quiet window as minutes-since-midnight so is_quiet is pure arithmetic
+QUIET_START_M = QUIET_START.hour * 60 + QUIET_START.minute
+QUIET_END_M = QUIET_END.hour * 60 + QUIET_END.minute
 
 DB_PATH = os.getenv("DB_PATH", "dora_telegram.db")
 
 
-def db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+# One long-lived connection for the whole process. The bot runs on a single
+# asyncio loop, so a plain lock serializing access is all we need; opening a
+# fresh connection per query costs more than the queries themselves.
+CONN = sqlite3.connect(DB_PATH, check_same_thread=False,
+                       isolation_level=None, cached_statements=256)
+CONN.row_factory = sqlite3.Row
+DB_LOCK = threading.Lock()
+
+# Hot-path SQL lives here as constants: sqlite3 caches prepared statements
+# by exact text per connection, so reusing the same string objects keeps
+# the cache hot and avoids re-tokenization.
+SQL_UPSERT_CHAT = "INSERT OR IGNORE INTO chats(chat_id, title) VALUES(?, ?)"
+SQL_INSERT_WALK = (
+    "INSERT INTO walks(chat_id, user_id, user_name, ts, poop)"
+    " VALUES(?, ?, ?, ?, NULL) RETURNING id"
+)
+SQL_BULK_INSERT_WALK = (
+    "INSERT INTO walks(chat_id, user_id, user_name, ts, poop)"
+    " VALUES(?, ?, ?, ?, ?)"
+)
+SQL_SET_POOP = "UPDATE walks SET poop=? WHERE id=?"
+SQL_SET_POOP_LATEST = """
+    UPDATE walks
+    SET poop=?
+    WHERE id = (
+        SELECT id FROM walks
+        WHERE chat_id=? AND user_id=?
+        ORDER BY ts DESC LIMIT 1
+    )
+"""
+SQL_STATS_TOTALS = "SELECT COUNT(*), MIN(ts), MAX(ts) FROM walks WHERE chat_id=?"
+SQL_STATS_POOP = "SELECT COALESCE(poop, 'unknown'), COUNT(*) FROM walks WHERE chat_id=? GROUP BY 1"
+SQL_EXPORT_WALKS = "SELECT ts, user_name, poop FROM walks WHERE chat_id=? ORDER BY ts ASC"
+SQL_ALERT_STATE = """
+    SELECT MAX(w.ts) AS last_ts, c.last_alert
+    FROM chats c LEFT JOIN walks w ON w.chat_id = c.chat_id
+    WHERE c.chat_id = ?
+"""
+SQL_SET_LAST_ALERT = "UPDATE chats SET last_alert=? WHERE chat_id=?"
+SQL_CHAT_IDS = "SELECT chat_id FROM chats"
+SQL_DIGEST_TOTALS = """
+    SELECT chat_id, COUNT(*) AS total, MAX(ts) AS last_ts,
+           (MAX(ts) - MIN(ts)) / 3600.0 / NULLIF(COUNT(*) - 1, 0) AS avg_gap
+    FROM walks GROUP BY chat_id
+"""
+SQL_DIGEST_POOP = """
+    SELECT chat_id, COALESCE(poop, 'unknown') AS poop, COUNT(*) AS n
+    FROM walks GROUP BY chat_id, poop
+"""
+
+ALERT_THROTTLE_S = 6 * 3600  # one alert max every 6 hours
 
 
 def init_db():
-    with db() as conn:
-        conn.execute("""
+    with DB_LOCK:
+        # WAL keeps readers (stats/csv) from blocking the writer, and
+        # synchronous=NORMAL drops the per-INSERT fsync; journal_mode
+        # persists in the db file, the rest applies per connection.
+        CONN.execute("PRAGMA journal_mode=WAL")
+        CONN.execute("PRAGMA synchronous=NORMAL")
+        CONN.execute("PRAGMA busy_timeout=5000")
+        CONN.execute("PRAGMA cache_size=-32000")
+        CONN.execute("PRAGMA temp_store=MEMORY")
+        CONN.execute("""
         CREATE TABLE IF NOT EXISTS walks(
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             chat_id INTEGER,
             user_id INTEGER,
             user_name TEXT,
-            ts_utc TEXT,
+            ts INTEGER,
             poop TEXT
         )""")
-        conn.execute("""
+        # migrate old databases that stored ISO strings in ts_utc
+        cols = {r["name"] for r in CONN.execute("PRAGMA table_info(walks)")}
+        if "ts_utc" in cols and "ts" not in cols:
+            CONN.execute("ALTER TABLE walks ADD COLUMN ts INTEGER")
+            CONN.execute(
+                "UPDATE walks SET ts = CAST(strftime('%s', ts_utc) AS INTEGER) WHERE ts IS NULL")
+            # old indexes covered ts_utc; rebuild them on the new column
+            CONN.execute("DROP INDEX IF EXISTS idx_walks_chat_ts")
+            CONN.execute("DROP INDEX IF EXISTS idx_walks_chat_user_ts")
+        CONN.execute("""
         CREATE TABLE IF NOT EXISTS chats(
             chat_id INTEGER PRIMARY KEY,
             title TEXT,
-            last_alert_utc TEXT
+            last_alert INTEGER
         )""")
+        # migrate alert timestamps to epoch seconds as well; updating the old
+        # last_alert_utc in place kept its TEXT affinity, which coerced the
+        # epoch values back to strings, so move to a fresh INTEGER column the
+        # same way walks.ts was migrated
+        cols = {r["name"] for r in CONN.execute("PRAGMA table_info(chats)")}
+        if "last_alert_utc" in cols and "last_alert" not in cols:
+            CONN.execute("ALTER TABLE chats ADD COLUMN last_alert INTEGER")
+            CONN.execute("""
+                UPDATE chats SET last_alert =
+                    CAST(CASE WHEN last_alert_utc LIKE '%-%'
+                              THEN strftime('%s', last_alert_utc)
+                              ELSE last_alert_utc END AS INTEGER)
+                WHERE last_alert_utc IS NOT NULL
+            """)
+        # every read path filters on chat_id (+ user_id) ordered by ts
+        CONN.execute(
+            "CREATE INDEX IF NOT EXISTS idx_walks_chat_ts ON walks(chat_id, ts DESC)")
+        CONN.execute(
+            "CREATE INDEX IF NOT EXISTS idx_walks_chat_user_ts ON walks(chat_id, user_id, ts DESC)")
 
 
 init_db()
 
+# chat ids already present in chats, so log_walk can skip the upsert on
+# every walk after the first one from a chat
+KNOWN_CHATS = {r["chat_id"] for r in CONN.execute(SQL_CHAT_IDS)}
 
-def now_utc():
-    return datetime.now(tz=ZoneInfo("UTC"))
+
+def import_walks(rows):
+    # bulk path for backfills/imports (e.g. restoring a CSV export):
+    # rows is an iterable of (chat_id, user_id, user_name, ts, poop) tuples,
+    # inserted via executemany under one transaction so the whole batch
+    # pays a single WAL commit instead of one per row
+    with DB_LOCK:
+        CONN.execute("BEGIN IMMEDIATE")
+        try:
+            CONN.executemany(SQL_BULK_INSERT_WALK, rows)
+            CONN.execute("COMMIT")
+        except Exception:
+            CONN.execute("ROLLBACK")
+            raise
 
 
-def last_walk_utc(chat_id: int) -> Optional[datetime]:
-    with db() as conn:
-        row = conn.execute(
-            "SELECT ts_utc FROM walks WHERE chat_id=? ORDER BY ts_utc DESC LIMIT 1",
-            (chat_id,)
-        ).fetchone()
-    if not row:
-        return None
-    return datetime.fromisoformat(row["ts_utc"]).replace(tzinfo=ZoneInfo("UTC"))
+def now_utc():
+    return datetime.now(tz=UTC)
 
 
 def is_quiet(local_dt: datetime) -> bool:
     # quiet from QUIET_START to QUIET_END; supports crossing midnight
-    start = local_dt.replace(
-        hour=QUIET_START.hour, minute=QUIET_START.minute, second=0, microsecond=0)
-    end = local_dt.replace(hour=QUIET_END.hour,
-                           minute=QUIET_END.minute, second=0, microsecond=0)
-    if QUIET_START <= QUIET_END:
-        return start <= local_dt <= end
+    m = local_dt.hour * 60 + local_dt.minute
+    if QUIET_START_M <= QUIET_END_M:
+        return QUIET_START_M <= m <= QUIET_END_M
     else:
         # window wraps midnight
-        return local_dt >= start or local_dt <= end
+        return m >= QUIET_START_M or m <= QUIET_END_M
 
 # ---------------- Core actions ----------------
 
@@ -98,25 +192,43 @@ def is_quiet(local_dt: datetime) -> bool:
 async def log_walk(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat = update.effective_chat
     user = update.effective_user
-    with db() as conn:
-        conn.execute(
-            "INSERT OR IGNORE INTO chats(chat_id, title) VALUES(?, ?)", (chat.id, chat.title))
-        conn.execute(
-            "INSERT INTO walks(chat_id, user_id, user_name, ts_utc, poop) VALUES(?, ?, ?, ?, NULL)",
-            (chat.id, user.id, user.full_name, now_utc().isoformat())
-        )
+    walk = (chat.id, user.id, user.full_name, int(now_utc().timestamp()))
+    with DB_LOCK:
+        if chat.id in KNOWN_CHATS:
+            row = CONN.execute(SQL_INSERT_WALK, walk).fetchone()
+        else:
+            # first walk from this chat: register it in the same transaction
+            # so both inserts share a single WAL commit
+            CONN.execute("BEGIN IMMEDIATE")
+            try:
+                CONN.execute(SQL_UPSERT_CHAT, (chat.id, chat.title))
+                row = CONN.execute(SQL_INSERT_WALK, walk).fetchone()
+                CONN.execute("COMMIT")
+            except Exception:
+                CONN.execute("ROLLBACK")
+                raise
+            KNOWN_CHATS.add(chat.id)
+    schedule_alert(context.job_queue, chat.id, MAX_HOURS * 3600)
     await update.effective_message.reply_text(
         f"✅ Paseo por {user.first_name} guardado. Gracias!"
     )
-    await send_poop_poll(update, context)
+    await send_poop_poll(update, context, row["id"])
 
 
-async def send_poop_poll(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# poll options are fixed; only the walk id in callback_data varies per poll
+POOP_OPTIONS = (
+    ("👍 Normal", "poop_ok"),
+    ("😕 Blanda", "poop_soft"),
+    ("💧 Diarrea", "poop_diarrhea"),
+    ("❌ No caca", "poop_none"),
+)
+
+
+async def send_poop_poll(update: Update, context: ContextTypes.DEFAULT_TYPE, walk_id: int):
+    # the walk id rides in callback_data so the vote updates by primary key
     keyboard = [
-        [InlineKeyboardButton("👍 Normal", callback_data="poop_ok")],
-        [InlineKeyboardButton("😕 Blanda", callback_data="poop_soft")],
-        [InlineKeyboardButton("💧 Diarrea", callback_data="poop_diarrhea")],
-        [InlineKeyboardButton("❌ No caca", callback_data="poop_none")],
+        [InlineKeyboardButton(label, callback_data=f"{action}:{walk_id}")]
+        for label, action in POOP_OPTIONS
     ]
     await update.effective_message.reply_text(
         "¿Cómo ha hecho la caca?",
@@ -133,148 +245,179 @@ async def handle_poop_vote(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "poop_diarrhea": "Diarrea",
         "poop_none": "none"
     }
-    val = mapping.get(q.data)
+    action, _, walk_id = q.data.partition(":")
+    val = mapping.get(action)
     if not val:
         return
-    chat_id = q.message.chat_id
-    user_id = q.from_user.id
-    with db() as conn:
-        conn.execute("""
-            UPDATE walks
-            SET poop=?
-            WHERE id = (
-                SELECT id FROM walks 
-                WHERE chat_id=? AND user_id=?
-                ORDER BY ts_utc DESC LIMIT 1
-            )
-        """, (val, chat_id, user_id))
+    if walk_id:
+        with DB_LOCK:
+            CONN.execute(SQL_SET_POOP, (val, int(walk_id)))
+    else:
+        # poll sent by an older version without the id in callback_data
+        with DB_LOCK:
+            CONN.execute(SQL_SET_POOP_LATEST,
+                         (val, q.message.chat_id, q.from_user.id))
     await q.edit_message_text(f"✅ Caca {val} guardada")
 
 # ---------------- Stats & CSV ----------------
 
 
-def chat_stats(chat_id: int) -> Tuple[int, Optional[datetime], Optional[datetime], float, dict]:
-    with db() as conn:
-        rows = conn.execute(
-            "SELECT ts_utc, poop FROM walks WHERE chat_id=? ORDER BY ts_utc ASC",
-            (chat_id,)
-        ).fetchall()
-    if not rows:
-        return 0, None, None, 0.0, {}
-    times = [datetime.fromisoformat(r["ts_utc"]).replace(
-        tzinfo=ZoneInfo("UTC")) for r in rows]
-    gaps = [(times[i] - times[i-1]).total_seconds() /
-            3600.0 for i in range(1, len(times))]
-    avg_gap = sum(gaps)/len(gaps) if gaps else 0.0
-    poop_counts = {}
-    for r in rows:
-        poop_counts[r["poop"] or "unknown"] = poop_counts.get(
-            r["poop"] or "unknown", 0) + 1
-    return len(rows), times[0], times[-1], avg_gap, poop_counts
+class ChatStats(NamedTuple):
+    total: int
+    first_ts: Optional[int]  # epoch seconds; callers format at the edge
+    last_ts: Optional[int]
+    avg_gap_h: float
+    poop_counts: dict
+
+
+def chat_stats(chat_id: int) -> ChatStats:
+    # Aggregation happens in SQLite so we never materialize the full history;
+    # avg gap is exact as (last-first)/(n-1).
+    with DB_LOCK:
+        total, first, last = CONN.execute(
+            SQL_STATS_TOTALS, (chat_id,)).fetchone()
+        counts = CONN.execute(SQL_STATS_POOP, (chat_id,)).fetchall()
+    if not total:
+        return ChatStats(0, None, None, 0.0, {})
+    avg_gap = (last - first) / 3600.0 / (total - 1) if total > 1 else 0.0
+    return ChatStats(total, first, last, avg_gap, dict(counts))
 
 
 async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    total, first, last, avg_gap, poop_counts = chat_stats(chat_id)
-    if total == 0:
+    stats = chat_stats(chat_id)
+    if stats.total == 0:
         await update.message.reply_text("No hay ningún paseo registrado aún.")
         return
-    first_local = first.astimezone(TZ).strftime("%Y-%m-%d %H:%M")
-    last_local = last.astimezone(TZ).strftime("%Y-%m-%d %H:%M")
-    poop_str = ", ".join([f"{k}: {v}" for k, v in poop_counts.items()])
+    first_local = datetime.fromtimestamp(
+        stats.first_ts, TZ).strftime("%Y-%m-%d %H:%M")
+    last_local = datetime.fromtimestamp(
+        stats.last_ts, TZ).strftime("%Y-%m-%d %H:%M")
+    poop_str = ", ".join([f"{k}: {v}" for k, v in stats.poop_counts.items()])
     await update.message.reply_text(
-        f"📊 Paseos: {total}\n"
+        f"📊 Paseos: {stats.total}\n"
         f"Primero: {first_local}\n"
         f"Último: {last_local}\n"
-        f"Tiempo medio entre paseos: {avg_gap:.1f} h\n"
+        f"Tiempo medio entre paseos: {stats.avg_gap_h:.1f} h\n"
         f"Cacas: {poop_str}"
     )
 
 
 async def cmd_csv(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    with db() as conn:
-        rows = conn.execute(
-            "SELECT ts_utc, user_name, poop FROM walks WHERE chat_id=? ORDER BY ts_utc ASC",
-            (chat_id,)
-        ).fetchall()
-    if not rows:
+    # stream rows from the cursor straight into one bytes buffer instead of
+    # fetchall + StringIO + encode (three full copies of the export)
+    buf = io.BytesIO()
+    text = io.TextIOWrapper(buf, encoding="utf-8",
+                            newline="", write_through=True)
+    writer = csv.writer(text)
+    writer.writerow(["timestamp_local", "timestamp_utc", "user", "poop"])
+    n_rows = 0
+    with DB_LOCK:
+        for r in CONN.execute(SQL_EXPORT_WALKS, (chat_id,)):
+            # one fromtimestamp per row; the UTC column is derived from it
+            dt_local = datetime.fromtimestamp(r["ts"], TZ)
+            writer.writerow([dt_local.isoformat(timespec="minutes"),
+                             dt_local.astimezone(UTC).isoformat(),
+                             r["user_name"], r["poop"] or ""])
+            n_rows += 1
+    text.detach()
+    if n_rows == 0:
         await update.message.reply_text("No data to export.")
         return
-    buf = io.StringIO()
-    writer = csv.writer(buf)
-    writer.writerow(["timestamp_local", "timestamp_utc", "user", "poop"])
-    for r in rows:
-        ts_utc = datetime.fromisoformat(
-            r["ts_utc"]).replace(tzinfo=ZoneInfo("UTC"))
-        writer.writerow([ts_utc.astimezone(TZ).isoformat(timespec="minutes"),
-                         ts_utc.isoformat(), r["user_name"], r["poop"] or ""])
     buf.seek(0)
     await update.message.reply_document(
-        document=io.BytesIO(buf.getvalue().encode()),
+        document=buf,
         filename="dora_walks.csv"
     )
 
 # ---------------- Scheduling ----------------
 
 
-async def overdue_check(context: ContextTypes.DEFAULT_TYPE):
-    # called every 30 min by JobQueue
-    for chat_id in list(context.application.chat_data.keys()):
-        await maybe_alert_chat(context, int(chat_id))
-
-
-async def maybe_alert_chat(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
-    last = last_walk_utc(chat_id)
-    if not last:
+def schedule_alert(job_queue, chat_id: int, delay: float):
+    # one pending alert job per chat; re-arming replaces the old one
+    name = f"alert-{chat_id}"
+    for job in job_queue.get_jobs_by_name(name):
+        job.schedule_removal()
+    job_queue.run_once(alert_check, when=max(delay, 0),
+                       chat_id=chat_id, name=name)
+
+
+async def alert_check(context: ContextTypes.DEFAULT_TYPE):
+    # one-shot job armed at last_walk + MAX_HOURS; instead of polling every
+    # chat every 30 min, it wakes exactly when an alert could be due and
+    # re-arms itself from the DB state
+    chat_id = context.job.chat_id
+    now = now_utc()
+    now_ts = int(now.timestamp())
+    with DB_LOCK:
+        row = CONN.execute(SQL_ALERT_STATE, (chat_id,)).fetchone()
+    if row["last_ts"] is None:
         return
-    hours = (now_utc() - last).total_seconds() / 3600.0
-    if hours < MAX_HOURS:
+    due_ts = row["last_ts"] + MAX_HOURS * 3600
+    if now_ts < due_ts:
+        # a walk was logged after this job was armed; wake again when due
+        schedule_alert(context.job_queue, chat_id, due_ts - now_ts)
         return
-    # throttle: one alert max every 6 hours
-    with db() as conn:
-        row = conn.execute(
-            "SELECT last_alert_utc FROM chats WHERE chat_id=?", (chat_id,)).fetchone()
-    last_alert = datetime.fromisoformat(row["last_alert_utc"]).replace(
-        tzinfo=ZoneInfo("UTC")) if row and row["last_alert_utc"] else None
-
-    local_now = now_utc().astimezone(TZ)
-    if is_quiet(local_now):
+    if is_quiet(now.astimezone(TZ)):
+        schedule_alert(context.job_queue, chat_id, 1800)
         return
-    if last_alert and (now_utc() - last_alert) < timedelta(hours=6):
+    last_alert = row["last_alert"]
+    if last_alert is not None and now_ts - last_alert < ALERT_THROTTLE_S:
+        schedule_alert(context.job_queue, chat_id,
+                       last_alert + ALERT_THROTTLE_S - now_ts)
         return
-
+    hours = (now_ts - row["last_ts"]) / 3600.0
     text = f"⏰ Han pasado {hours:.1f}h desde la última salida de Dora. Alguien la puede sacar?"
-    await context.bot.send_message(chat_id=chat_id, text=text)
-
-    with db() as conn:
-        conn.execute("UPDATE chats SET last_alert_utc=? WHERE chat_id=?",
-                     (now_utc().isoformat(), chat_id))
+    try:
+        await context.bot.send_message(chat_id=chat_id, text=text)
+    except Exception:
+        # a failed send (network hiccup, bot removed from the chat) must not
+        # kill the chain: this is a one-shot job, so re-arm and retry
+        schedule_alert(context.job_queue, chat_id, 1800)
+        return
+    with DB_LOCK:
+        CONN.execute(SQL_SET_LAST_ALERT, (now_ts, chat_id))
+    # keep reminding until somebody walks her
+    schedule_alert(context.job_queue, chat_id, ALERT_THROTTLE_S)
 
 
 async def daily_digest(context: ContextTypes.DEFAULT_TYPE):
-    # simple morning digest for each chat the bot has seen
-    for chat_id in list(context.application.chat_data.keys()):
-        total, first, last, avg_gap, poop_counts = chat_stats(int(chat_id))
-        if total == 0:
-            continue
-        last_s = last.astimezone(TZ).strftime("%H:%M %d-%m")
-        poop_str = ", ".join([f"{k}: {v}" for k, v in poop_counts.items()])
+    # simple morning digest for each chat the bot has seen; stats for every
+    # chat come from two grouped queries (one scan of walks each) instead of
+    # a chat_stats round trip per chat
+    with DB_LOCK:
+        totals = CONN.execute(SQL_DIGEST_TOTALS).fetchall()
+        poop_rows = CONN.execute(SQL_DIGEST_POOP).fetchall()
+    poop_by_chat = {}
+    for r in poop_rows:
+        poop_by_chat.setdefault(r["chat_id"], {})[r["poop"]] = r["n"]
+    for row in totals:
+        chat_id = row["chat_id"]
+        last_s = datetime.fromtimestamp(
+            row["last_ts"], TZ).strftime("%H:%M %d-%m")
+        poop_str = ", ".join(
+            [f"{k}: {v}" for k, v in poop_by_chat.get(chat_id, {}).items()])
         msg = (f"☀️ Resumen diario de ayer\n"
-               f"Paseos: {total} | Last: {last_s}\n"
-               f"Tiempo medio entre paseos: {avg_gap:.1f} h\n"
+               f"Paseos: {row['total']} | Last: {last_s}\n"
+               f"Tiempo medio entre paseos: {row['avg_gap'] or 0.0:.1f} h\n"
                f"Cacas: {poop_str}")
-        await context.bot.send_message(chat_id=int(chat_id), text=msg)
+        try:
+            await context.bot.send_message(chat_id=chat_id, text=msg)
+        except Exception:
+            # one unreachable chat (e.g. the bot was removed) must not
+            # abort the digest for everyone else
+            continue
 
 # ---------------- Commands & message triggers ----------------
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # remember the chat so schedulers know where to post
-    context.chat_data.setdefault(str(update.effective_chat.id), {})
-    with db() as conn:
-        conn.execute("INSERT OR IGNORE INTO chats(chat_id, title) VALUES(?, ?)",
+    with DB_LOCK:
+        CONN.execute(SQL_UPSERT_CHAT,
                      (update.effective_chat.id, update.effective_chat.title))
+        KNOWN_CHATS.add(update.effective_chat.id)
     await update.message.reply_text(
         "Hola! Envía /paseo cuando saques a Dora, y luego selecciona cómo ha hecho la caca.")
 
@@ -283,12 +426,16 @@ async def cmd_walk(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await log_walk(update, context)
 
 
+# walk triggers compiled once into a single case-insensitive alternation,
+# so each message is scanned in one pass instead of once per trigger
+TRIGGER_RE = re.compile(
+    r"walk|out|paseo|salida|he salido con dora|sacado a dora", re.IGNORECASE)
+
+
 async def keyword_listener(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # If privacy mode is OFF, detect messages like "walk", "paseo", etc.
-    text = (update.message.text or "").strip().lower()
-    triggers = {"walk", "out", "paseo", "salida",
-                "he salido con dora", "sacado a dora"}
-    if any(t in text.lower() for t in triggers):
+    text = update.message.text
+    if text and TRIGGER_RE.search(text):
         await log_walk(update, context)
 
 # ---------------- Main ----------------
@@ -311,8 +458,12 @@ def main():
     app.add_handler(MessageHandler(
         filters.TEXT & ~filters.COMMAND, keyword_listener))
 
-    # Schedule: overdue check every 30 min; daily digest at 08:30
-    app.job_queue.run_repeating(overdue_check, interval=1800, first=60)
+    # Schedule: one alert job per known chat (each re-arms itself from the
+    # DB, so nothing polls between events); daily digest in the morning
+    with DB_LOCK:
+        chat_ids = [r["chat_id"] for r in CONN.execute(SQL_CHAT_IDS)]
+    for chat_id in chat_ids:
+        schedule_alert(app.job_queue, chat_id, 60)
     app.job_queue.run_daily(
         daily_digest, time=time(hour=9, minute=00, tzinfo=TZ))
 